@@ -1,7 +1,8 @@
 import django.contrib.auth.password_validation as validators
 from django.contrib.auth import authenticate, get_user_model
 from django.contrib.auth.hashers import make_password
-from django.shortcuts import get_object_or_404
+from django.db.models import Prefetch
+from django.utils.functional import cached_property
 from drf_base64.fields import Base64ImageField
 from rest_framework import serializers
 
@@ -9,6 +10,8 @@ from recipes.models import Ingredient, Recipe, RecipeIngredient, Subscribe, Tag
 
 User = get_user_model()
 ERR_MSG = 'Не удается войти в систему с предоставленными учетными данными.'
+INGREDIENTS_BATCH_SIZE = 500
+RECIPES_LIMIT = 3
 
 
 class TokenSerializer(serializers.Serializer):
@@ -45,19 +48,10 @@ class TokenSerializer(serializers.Serializer):
         return attrs
 
 
-class GetIsSubscribedMixin:
-
-    def get_is_subscribed(self, obj):
-        user = self.context['request'].user
-        if not user.is_authenticated:
-            return False
-        return user.follower.filter(author=obj).exists()
-
-
-class UserListSerializer(
-        GetIsSubscribedMixin,
-        serializers.ModelSerializer):
-    is_subscribed = serializers.BooleanField(read_only=True)
+class UserListSerializer(serializers.ModelSerializer):
+    is_subscribed = serializers.BooleanField(
+        read_only=True,
+        default=False)
 
     class Meta:
         model = User
@@ -136,12 +130,11 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
             'id', 'name', 'measurement_unit', 'amount')
 
 
-class RecipeUserSerializer(
-        GetIsSubscribedMixin,
-        serializers.ModelSerializer):
+class RecipeUserSerializer(serializers.ModelSerializer):
 
-    is_subscribed = serializers.SerializerMethodField(
-        read_only=True)
+    is_subscribed = serializers.BooleanField(
+        read_only=True,
+        default=False)
 
     class Meta:
         model = User
@@ -160,13 +153,32 @@ class IngredientsEditSerializer(serializers.ModelSerializer):
         fields = ('id', 'amount')
 
 
+class TagsField(serializers.ManyRelatedField):
+    """Список тэгов, загружаемых одним запросом."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        try:
+            ids = [int(pk) for pk in data]
+        except (TypeError, ValueError):
+            raise serializers.ValidationError(
+                'Ожидается список id тэгов!')
+        tags = Tag.objects.in_bulk(ids)
+        missing = [pk for pk in ids if pk not in tags]
+        if missing:
+            raise serializers.ValidationError(
+                f'Тэгов {missing} не существует!')
+        return [tags[pk] for pk in ids]
+
+
 class RecipeWriteSerializer(serializers.ModelSerializer):
     image = Base64ImageField(
         max_length=None,
         use_url=True)
-    tags = serializers.PrimaryKeyRelatedField(
-        many=True,
-        queryset=Tag.objects.all())
+    tags = TagsField(
+        child_relation=serializers.PrimaryKeyRelatedField(
+            queryset=Tag.objects.all()))
     ingredients = IngredientsEditSerializer(
         many=True)
 
@@ -175,25 +187,11 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('author',)
 
-    def validate(self, data):
-        ingredients = data['ingredients']
-        ingredient_list = []
-        for items in ingredients:
-            ingredient = get_object_or_404(
-                Ingredient, id=items['id'])
-            if ingredient in ingredient_list:
-                raise serializers.ValidationError(
-                    'Ингредиент должен быть уникальным!')
-            ingredient_list.append(ingredient)
-        tags = data['tags']
+    def validate_tags(self, tags):
         if not tags:
             raise serializers.ValidationError(
                 'Нужен хотя бы один тэг для рецепта!')
-        for tag_name in tags:
-            if not Tag.objects.filter(name=tag_name).exists():
-                raise serializers.ValidationError(
-                    f'Тэга {tag_name} не существует!')
-        return data
+        return tags
 
     def validate_cooking_time(self, cooking_time):
         if int(cooking_time) < 1:
@@ -205,18 +203,51 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
         if not ingredients:
             raise serializers.ValidationError(
                 'Мин. 1 ингредиент в рецепте!')
+        ingredient_ids = set()
         for ingredient in ingredients:
-            if int(ingredient.get('amount')) < 1:
+            if ingredient['amount'] < 1:
                 raise serializers.ValidationError(
                     'Количество ингредиента >= 1!')
+            if ingredient['id'] in ingredient_ids:
+                raise serializers.ValidationError(
+                    'Ингредиент должен быть уникальным!')
+            ingredient_ids.add(ingredient['id'])
+        if Ingredient.objects.filter(
+                id__in=ingredient_ids).count() != len(ingredient_ids):
+            raise serializers.ValidationError(
+                'Такого ингредиента не существует!')
         return ingredients
 
     def create_ingredients(self, ingredients, recipe):
-        for ingredient in ingredients:
-            RecipeIngredient.objects.create(
+        RecipeIngredient.objects.bulk_create(
+            [RecipeIngredient(
                 recipe=recipe,
                 ingredient_id=ingredient.get('id'),
                 amount=ingredient.get('amount'), )
+             for ingredient in ingredients],
+            batch_size=INGREDIENTS_BATCH_SIZE)
+
+    def update_ingredients(self, ingredients, recipe):
+        existing = {item.ingredient_id: item for item in recipe.recipe.all()}
+        amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in ingredients}
+        removed = existing.keys() - amounts.keys()
+        if removed:
+            RecipeIngredient.objects.filter(
+                recipe=recipe, ingredient_id__in=removed).delete()
+        changed = []
+        for ingredient_id, item in existing.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and item.amount != amount:
+                item.amount = amount
+                changed.append(item)
+        RecipeIngredient.objects.bulk_update(
+            changed, ('amount',), batch_size=INGREDIENTS_BATCH_SIZE)
+        self.create_ingredients(
+            [ingredient for ingredient in ingredients
+             if ingredient['id'] not in existing],
+            recipe)
 
     def create(self, validated_data):
         ingredients = validated_data.pop('ingredients')
@@ -228,9 +259,8 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
 
     def update(self, instance, validated_data):
         if 'ingredients' in validated_data:
-            ingredients = validated_data.pop('ingredients')
-            instance.ingredients.clear()
-            self.create_ingredients(ingredients, instance)
+            self.update_ingredients(
+                validated_data.pop('ingredients'), instance)
         if 'tags' in validated_data:
             instance.tags.set(
                 validated_data.pop('tags'))
@@ -258,14 +288,25 @@ class RecipeReadSerializer(serializers.ModelSerializer):
         required=True,
         source='recipe')
     is_favorited = serializers.BooleanField(
-        read_only=True)
+        read_only=True,
+        default=False)
     is_in_shopping_cart = serializers.BooleanField(
-        read_only=True)
+        read_only=True,
+        default=False)
 
     class Meta:
         model = Recipe
         fields = '__all__'
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.prefetch_related(
+            'tags',
+            Prefetch(
+                'recipe',
+                queryset=RecipeIngredient.objects.select_related(
+                    'ingredient')))
+
 
 class SubscribeRecipeSerializer(serializers.ModelSerializer):
 
@@ -286,8 +327,10 @@ class SubscribeSerializer(serializers.ModelSerializer):
     last_name = serializers.CharField(
         source='author.last_name')
     recipes = serializers.SerializerMethodField()
-    is_subscribed = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
+    is_subscribed = serializers.BooleanField(
+        read_only=True)
+    recipes_count = serializers.IntegerField(
+        read_only=True)
 
     class Meta:
         model = Subscribe
@@ -295,21 +338,23 @@ class SubscribeSerializer(serializers.ModelSerializer):
             'email', 'id', 'username', 'first_name', 'last_name',
             'is_subscribed', 'recipes', 'recipes_count',)
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.select_related('author').prefetch_related(
+            Prefetch(
+                'author__recipe',
+                queryset=Recipe.objects.only(
+                    *SubscribeRecipeSerializer.Meta.fields, 'author')))
+
+    @cached_property
+    def recipes_limit(self):
+        try:
+            limit = int(self.context['request'].GET['recipes_limit'])
+        except (KeyError, ValueError):
+            return RECIPES_LIMIT
+        return limit if limit >= 0 else RECIPES_LIMIT
+
     def get_recipes(self, obj):
-        request = self.context.get('request')
-        limit = request.GET.get('recipes_limit')
-        recipes = (
-            obj.author.recipe.all()[:int(limit)] if limit
-            else obj.author.recipe.all())
         return SubscribeRecipeSerializer(
-            recipes,
+            obj.author.recipe.all()[:self.recipes_limit],
             many=True).data
-
-    def get_recipes_count(self, obj: Subscribe):
-        return Recipe.objects.filter(author=obj.author).count()
-
-    def get_is_subscribed(self, obj: Subscribe):
-        request = self.context.get('request')
-        return Subscribe.objects.filter(
-            user=request.user, author=obj.author
-        ).exists()
@@ -1,11 +1,17 @@
 import io
+import os
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import make_password
+from django.db.models import BooleanField, Prefetch
 from django.db.models.aggregates import Count, Sum
 from django.db.models.expressions import Exists, OuterRef, Value
 from django.http import FileResponse
 from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_page
+from django.views.decorators.vary import vary_on_headers
 from djoser.views import UserViewSet
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
@@ -21,8 +27,8 @@ from rest_framework.response import Response
 
 from api.filters import IngredientFilter, RecipeFilter
 from api.permissions import IsAdminOrReadOnly
-from recipes.models import (FavoriteRecipe, Ingredient, Recipe, ShoppingCart,
-                            Subscribe, Tag)
+from recipes.models import (FavoriteRecipe, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart, Tag)
 from .serializers import (IngredientSerializer, RecipeReadSerializer,
                           RecipeWriteSerializer, SubscribeRecipeSerializer,
                           SubscribeSerializer, TagSerializer, TokenSerializer,
@@ -31,6 +37,11 @@ from .serializers import (IngredientSerializer, RecipeReadSerializer,
 
 User = get_user_model()
 FILENAME = 'shoppingcart.pdf'
+FONT = 'Roboto'
+LIST_CACHE_TIMEOUT = 60 * 60
+
+pdfmetrics.registerFont(TTFont(
+    FONT, os.path.join(settings.BASE_DIR, 'Roboto.ttf'), 'UTF-8'))
 
 
 class GetObjectMixin:
@@ -52,8 +63,38 @@ class PermissionAndPaginationMixin:
     permission_classes = (IsAdminOrReadOnly,)
     pagination_class = None
 
+    @method_decorator(cache_page(LIST_CACHE_TIMEOUT))
+    @method_decorator(vary_on_headers('Accept'))
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+
+class AnnotateIsSubscribedMixin:
+    """Миксина для пометки авторов, на которых подписан пользователь."""
+
+    def annotate_is_subscribed(self, queryset):
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset.annotate(
+                is_subscribed=Value(False, output_field=BooleanField()))
+        return queryset.annotate(
+            is_subscribed=Exists(
+                user.follower.filter(author=OuterRef('id'))))
+
+
+class SubscriptionsMixin:
+    """Миксина для выборки подписок вместе с рецептами авторов."""
+
+    def get_subscriptions(self):
+        return SubscribeSerializer.setup_eager_loading(
+            self.request.user.follower.all()
+        ).annotate(
+            recipes_count=Count('author__recipe'),
+            is_subscribed=Value(True, output_field=BooleanField()), )
+
 
 class AddAndDeleteSubscribe(
+        SubscriptionsMixin,
         generics.RetrieveDestroyAPIView,
         generics.ListCreateAPIView):
     """Подписка и отписка от пользователя."""
@@ -61,17 +102,11 @@ class AddAndDeleteSubscribe(
     serializer_class = SubscribeSerializer
 
     def get_queryset(self):
-        return self.request.user.follower.select_related(
-            'following'
-        ).prefetch_related(
-            'following__recipe'
-        ).annotate(
-            recipes_count=Count('following__recipe'),
-            is_subscribed=Value(True), )
+        return self.get_subscriptions()
 
     def get_object(self):
         user_id = self.kwargs['user_id']
-        user = get_object_or_404(User, id=user_id)
+        user = get_object_or_404(User.objects.only('id'), id=user_id)
         self.check_object_permissions(self.request, user)
         return user
 
@@ -81,16 +116,24 @@ class AddAndDeleteSubscribe(
             return Response(
                 {'errors': 'На самого себя не подписаться!'},
                 status=status.HTTP_400_BAD_REQUEST)
-        if request.user.follower.filter(author=instance).exists():
+        subs, created = request.user.follower.get_or_create(
+            author=instance)
+        if not created:
             return Response(
                 {'errors': 'Уже подписан!'},
                 status=status.HTTP_400_BAD_REQUEST)
-        subs = request.user.follower.create(author=instance)
-        serializer = self.get_serializer(subs)
+        serializer = self.get_serializer(
+            self.get_queryset().get(id=subs.id))
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    def perform_destroy(self, instance):
-        self.request.user.follower.filter(author=instance).delete()
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        deleted, _ = request.user.follower.filter(author=instance).delete()
+        if not deleted:
+            return Response(
+                {'errors': 'Подписки не было!'},
+                status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 class AddDeleteFavoriteRecipe(
@@ -101,12 +144,26 @@ class AddDeleteFavoriteRecipe(
 
     def create(self, request, *args, **kwargs):
         instance = self.get_object()
-        request.user.favorite_recipe.recipe.add(instance)
+        _, created = FavoriteRecipe.recipe.through.objects.get_or_create(
+            favoriterecipe=request.user.favorite_recipe,
+            recipe=instance)
+        if not created:
+            return Response(
+                {'errors': 'Рецепт уже в избранном!'},
+                status=status.HTTP_400_BAD_REQUEST)
         serializer = self.get_serializer(instance)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    def perform_destroy(self, instance):
-        self.request.user.favorite_recipe.recipe.remove(instance)
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        deleted, _ = FavoriteRecipe.recipe.through.objects.filter(
+            favoriterecipe__user=request.user,
+            recipe=instance).delete()
+        if not deleted:
+            return Response(
+                {'errors': 'Рецепта не было в избранном!'},
+                status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 class AddDeleteShoppingCart(
@@ -117,12 +174,26 @@ class AddDeleteShoppingCart(
 
     def create(self, request, *args, **kwargs):
         instance = self.get_object()
-        request.user.shopping_cart.recipe.add(instance)
+        _, created = ShoppingCart.recipe.through.objects.get_or_create(
+            shoppingcart=request.user.shopping_cart,
+            recipe=instance)
+        if not created:
+            return Response(
+                {'errors': 'Рецепт уже в списке покупок!'},
+                status=status.HTTP_400_BAD_REQUEST)
         serializer = self.get_serializer(instance)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    def perform_destroy(self, instance):
-        self.request.user.shopping_cart.recipe.remove(instance)
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        deleted, _ = ShoppingCart.recipe.through.objects.filter(
+            shoppingcart__user=request.user,
+            recipe=instance).delete()
+        if not deleted:
+            return Response(
+                {'errors': 'Рецепта не было в списке покупок!'},
+                status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 class AuthToken(ObtainAuthToken):
@@ -141,21 +212,17 @@ class AuthToken(ObtainAuthToken):
             status=status.HTTP_201_CREATED)
 
 
-class UsersViewSet(UserViewSet):
+class UsersViewSet(
+        AnnotateIsSubscribedMixin,
+        SubscriptionsMixin,
+        UserViewSet):
     """Пользователи."""
 
     serializer_class = UserListSerializer
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self):
-        return User.objects.annotate(
-            is_subscribed=Exists(
-                self.request.user.follower.filter(
-                    author=OuterRef('id'))
-            )).prefetch_related(
-                'follower', 'following'
-        ) if self.request.user.is_authenticated else User.objects.annotate(
-            is_subscribed=Value(False))
+        return self.annotate_is_subscribed(User.objects.all())
 
     def get_serializer_class(self):
         if self.request.method.lower() == 'post':
@@ -172,16 +239,16 @@ class UsersViewSet(UserViewSet):
     def subscriptions(self, request):
         """Получить на кого пользователь подписан."""
 
-        user = request.user
-        queryset = Subscribe.objects.filter(user=user)
-        pages = self.paginate_queryset(queryset)
+        pages = self.paginate_queryset(self.get_subscriptions())
         serializer = SubscribeSerializer(
             pages, many=True,
             context={'request': request})
         return self.get_paginated_response(serializer.data)
 
 
-class RecipesViewSet(viewsets.ModelViewSet):
+class RecipesViewSet(
+        AnnotateIsSubscribedMixin,
+        viewsets.ModelViewSet):
     """Рецепты."""
 
     queryset = Recipe.objects.all()
@@ -194,23 +261,28 @@ class RecipesViewSet(viewsets.ModelViewSet):
         return RecipeWriteSerializer
 
     def get_queryset(self):
-        return Recipe.objects.annotate(
-            is_favorited=Exists(
-                FavoriteRecipe.objects.filter(
-                    user=self.request.user, recipe=OuterRef('id'))),
-            is_in_shopping_cart=Exists(
-                ShoppingCart.objects.filter(
-                    user=self.request.user,
-                    recipe=OuterRef('id')))
-        ).select_related('author').prefetch_related(
-            'tags', 'ingredients', 'recipe',
-            'shopping_cart', 'favorite_recipe'
-        ) if self.request.user.is_authenticated else Recipe.objects.annotate(
-            is_in_shopping_cart=Value(False),
-            is_favorited=Value(False),
-        ).select_related('author').prefetch_related(
-            'tags', 'ingredients', 'recipe',
-            'shopping_cart', 'favorite_recipe')
+        user = self.request.user
+        if user.is_authenticated:
+            queryset = Recipe.objects.annotate(
+                is_favorited=Exists(
+                    FavoriteRecipe.objects.filter(
+                        user=user, recipe=OuterRef('id'))),
+                is_in_shopping_cart=Exists(
+                    ShoppingCart.objects.filter(
+                        user=user, recipe=OuterRef('id'))))
+        else:
+            queryset = Recipe.objects.annotate(
+                is_in_shopping_cart=Value(False, output_field=BooleanField()),
+                is_favorited=Value(False, output_field=BooleanField()))
+        queryset = queryset.prefetch_related(
+            Prefetch(
+                'author',
+                queryset=self.annotate_is_subscribed(User.objects.all())))
+        if self.request.method not in SAFE_METHODS:
+            # Связанные объекты при записи перезаписываются,
+            # предзагруженный кэш был бы устаревшим.
+            return queryset
+        return RecipeReadSerializer.setup_eager_loading(queryset)
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -224,37 +296,34 @@ class RecipesViewSet(viewsets.ModelViewSet):
 
         buffer = io.BytesIO()
         page = canvas.Canvas(buffer)
-        pdfmetrics.registerFont(TTFont('Roboto', 'Roboto.ttf', 'UTF-8'))
         x_position, y_position = 50, 800
-        shopping_cart = (
-            request.user.shopping_cart.recipe.
-            values(
-                'ingredients__name',
-                'ingredients__measurement_unit'
-            ).annotate(amount=Sum('recipe__amount')).order_by())
-        page.setFont('Roboto', 14)
+        shopping_cart = list(
+            RecipeIngredient.objects.filter(
+                recipe__shopping_cart__user=request.user
+            ).values_list(
+                'ingredient__name',
+                'ingredient__measurement_unit'
+            ).annotate(total=Sum('amount')).order_by('ingredient__name'))
+        page.setFont(FONT, 14)
         if shopping_cart:
             indent = 20
             page.drawString(x_position, y_position, 'Cписок покупок:')
-            for index, recipe in enumerate(shopping_cart, start=1):
+            for index, (name, measurement_unit, amount) in enumerate(
+                    shopping_cart, start=1):
                 page.drawString(
                     x_position, y_position - indent,
-                    f'{index}. {recipe["ingredients__name"]} - '
-                    f'{recipe["amount"]} '
-                    f'{recipe["ingredients__measurement_unit"]}.')
+                    f'{index}. {name} - {amount} {measurement_unit}.')
                 y_position -= 15
                 if y_position <= 50:
                     page.showPage()
+                    page.setFont(FONT, 14)
                     y_position = 800
-            page.save()
-            buffer.seek(0)
-            return FileResponse(
-                buffer, as_attachment=True, filename=FILENAME)
-        page.setFont('Roboto', 24)
-        page.drawString(
-            x_position,
-            y_position,
-            'Cписок покупок пуст!')
+        else:
+            page.setFont(FONT, 24)
+            page.drawString(
+                x_position,
+                y_position,
+                'Cписок покупок пуст!')
         page.save()
         buffer.seek(0)
         return FileResponse(buffer, as_attachment=True, filename=FILENAME)
@@ -74,6 +74,7 @@ DATABASES = {
         ),
         "HOST": os.getenv("DB_HOST", default="db"),
         "PORT": os.getenv("DB_PORT", default="5432"),
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE") or 60),
     }
 }
 